@@ -25,6 +25,7 @@
 # <http://www.gnu.org/licenses/>.
 
 import os
+import hashlib
 from abc import ABCMeta, abstractmethod 
 from functools import wraps
 import logging
@@ -33,9 +34,19 @@ import sys
 
 class environmentHandlerInterface(metaclass=ABCMeta):
 
+    mode = None  # push mode name, defined by subclasses
+
     def __init__(self,conf):
         self.conf = conf
 
+    @property
+    def destination_root(self):
+        return self.conf.destination_roots[self.mode]
+
+    @property
+    def destination(self):
+        return self.conf.destination(self.mode)
+
     def arealoop(func):
         @wraps(func)
         def ret_func(self, areas, **kwargs):
@@ -55,6 +66,13 @@ class environmentHandlerInterface(metaclass=ABCMeta):
     def download(self):
         pass
 
+    @abstractmethod
+    def promote(self, source, destination):
+        """Copy the pushed environment source to destination on the backend
+           side, without transferring the files. Both are (environment,
+           version) tuples."""
+        pass
+
     @staticmethod
     def _formatted_list_results(envs):
         """Compose multiline string of formatted results w/ list comprehension
@@ -77,6 +95,37 @@ class environmentHandlerInterface(metaclass=ABCMeta):
                 upload_file_paths.append(relative_path)
         return upload_file_paths
 
+    def _find_duplicate_files(self, source_path):
+        """Detect content-identical files under source_path. Returns a dict
+           with the relative path of all files having at least one duplicate as
+           keys, and the relative path of the first of these files in sorted
+           order as value. This first file is the one to transfer, the others
+           can be materialized as copies of it on the destination."""
+        # group files by size first to hash only the potential duplicates
+        sizes = {}
+        for file_path in self._list_upload_file_paths(source_path):
+            size = os.path.getsize(os.path.join(source_path, file_path))
+            sizes.setdefault(size, []).append(file_path)
+
+        duplicates = {}
+        for file_paths in sizes.values():
+            if len(file_paths) < 2:
+                continue
+            digests = {}
+            for file_path in sorted(file_paths):
+                digest = hashlib.sha256()
+                with open(os.path.join(source_path, file_path), 'rb') as fh:
+                    for block in iter(lambda: fh.read(1024 * 1024), b''):
+                        digest.update(block)
+                digests.setdefault(digest.digest(), []).append(file_path)
+            for group in digests.values():
+                if len(group) > 1:
+                    for file_path in group:
+                        duplicates[file_path] = group[0]
+        logger.debug("Found %d files with identical content in %s",
+                     len(duplicates), source_path)
+        return duplicates
+
     def _get_full_paths(self, source_path, destination_path, file_path):
         # Determine file paths
         if os.path.isfile(source_path):
@@ -90,16 +139,15 @@ class environmentHandlerInterface(metaclass=ABCMeta):
 
 class environmentHandlerFactory(object):
 
-    def __new__(cls ,conf):
-        if conf.mode == 'posix':
+    def __new__(cls, conf, mode):
+        if mode == 'posix':
             from hpcconfig import environmentHandler_posix as ehp
             return ehp.environmentHandler_posix(conf)
-        elif conf.mode == 'sftp':
+        elif mode == 'sftp':
             from hpcconfig import environmentHandler_sftp as ehsftp
             return ehsftp.environmentHandler_sftp(conf)
-        elif conf.mode == 's3':
+        elif mode == 's3':
             from hpcconfig import environmentHandler_s3 as ehs3
             return ehs3.environmentHandler_s3(conf)
         else:
-            raise NotImplementedError("invalid configuration mode provided", conf.mode)
-
+            raise NotImplementedError("invalid configuration mode provided", mode)
@@ -37,23 +37,24 @@ from hpcconfig import environmentHandler as eh
 
 class environmentHandler_posix(eh.environmentHandlerInterface):
 
+    mode = 'posix'
     def __init__(self,conf):
         eh.environmentHandlerInterface.__init__(self, conf)
 
     def list(self):
         """List pushed environments in POSIX directory."""
 
-        logger.info("posix list: in %s", self.conf.destination_root)
+        logger.info("posix list: in %s", self.destination_root)
 
-        if not os.path.isdir(self.conf.destination_root):
+        if not os.path.isdir(self.destination_root):
             logger.info("posix list: no environment")
             return
 
-        env_dirs = sorted(os.listdir(self.conf.destination_root))
+        env_dirs = sorted(os.listdir(self.destination_root))
         # build list of envs tuples (name, mtime)
         envs = [ (env_dir,
                   datetime.utcfromtimestamp(
-                    os.stat(os.path.join(self.conf.destination_root, env_dir)).st_mtime) \
+                    os.stat(os.path.join(self.destination_root, env_dir)).st_mtime) \
                     .strftime('%Y-%m-%d %H:%M:%S'))
                  for env_dir in env_dirs ]
         result_s = super()._formatted_list_results(envs)
@@ -61,33 +62,28 @@ class environmentHandler_posix(eh.environmentHandlerInterface):
         logger.info("posix list: available environment:\n%s", result_s)
 
     def upload(self):
-        if not os.path.isdir(self.conf.destination):
-            logger.debug("posix push: create destination dir %s", self.conf.destination)
-            os.makedirs(self.conf.destination, exist_ok=True)
+        if not os.path.isdir(self.destination):
+            logger.debug("posix push: create destination dir %s", self.destination)
+            os.makedirs(self.destination, exist_ok=True)
 
         self.handle_area(self.conf.areas)
 
-        dir_files = os.path.join(self.conf.destination, 'files')
+        dir_files = os.path.join(self.destination, 'files')
         if os.path.isdir(dir_files):
             logger.debug("posix push: removing push private files dir %s", dir_files)
             shutil.rmtree(dir_files)
 
         logger.debug("posix push: copying private files")
-        # copytree() default copy_function is shutil.copy2() which does not manage
-        # directories. When the file is a symlink, copytree() resolve the link and
-        # directly call copy2() with the target of the link. It fails with errno 21
-        # when the target is a directory. To avoid this bug, use an alternate copy
-        # function conf_copy() to properly handle symlinks on directories.
-        shutil.copytree(self.conf.dir_files_private, dir_files, copy_function=self.conf.copy_fun)
+        self._posix_copy_dedup(self.conf.dir_files_private, dir_files)
         logger.debug("posix push: copying puppet conf")
-        shutil.copy(self.conf.conf_puppet, self.conf.destination)
+        self._posix_copy_file(self.conf.conf_puppet, self.destination)
         logger.debug("posix push: copying hiera conf")
-        shutil.copy(self.conf.conf_hiera, self.conf.destination)
+        self._posix_copy_file(self.conf.conf_hiera, self.destination)
         logger.debug("posix push: copying private cluster nodes description")
-        shutil.copy(self.conf.nodes_private, self.conf.destination)
+        self._posix_copy_file(self.conf.nodes_private, self.destination)
 
         # Set permissions
-        for root, dirs, files in os.walk(self.conf.destination):
+        for root, dirs, files in os.walk(self.destination):
             for dir_name in dirs:
                 os.chmod(os.path.join(root, dir_name), self.conf.posix_dir_mode)
             for file_name in files:
@@ -96,10 +92,72 @@ class environmentHandler_posix(eh.environmentHandlerInterface):
     def download(self):
         raise NotImplementedError("TODO")
 
+    def promote(self, source, destination):
+        """Promote environment with a tree of hardlinks. The tree is built
+           aside and then swapped with the destination."""
+        source = self.conf.environment_path(self.mode, *source)
+        destination = self.conf.environment_path(self.mode, *destination)
+        if not os.path.isdir(source):
+            raise RuntimeError("source environment %s not found" % source)
+        logger.info("posix promote: linking %s to %s", source, destination)
+
+        dest_tmp = destination + '.promote'
+        dest_old = destination + '.old'
+        for path in [dest_tmp, dest_old]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copytree(source, dest_tmp, copy_function=os.link)
+
+        if os.path.isdir(destination):
+            os.rename(destination, dest_old)
+        os.rename(dest_tmp, destination)
+        if os.path.isdir(dest_old):
+            shutil.rmtree(dest_old)
+
     @eh.environmentHandlerInterface.arealoop
     def handle_area(self, area):
         logger.debug("posix push: copying area %s tarball", area)
-        area_dest = os.path.join(self.conf.destination, area)
+        area_dest = os.path.join(self.destination, area)
         os.makedirs(area_dest, exist_ok=True)
-        shutil.copy(self.conf.archive_path(area), area_dest)
-
+        self._posix_copy_file(self.conf.archive_path(area), area_dest)
+
+    def _posix_copy_file(self, source_file_path, destination_dir):
+        """Copy file in destination_dir. The existing destination file is
+           removed first as it may be hardlinked to the same file in a promoted
+           environment, which must not be modified."""
+        dest_file_path = os.path.join(destination_dir,
+                                      os.path.basename(source_file_path))
+        if os.path.lexists(dest_file_path):
+            os.unlink(dest_file_path)
+        shutil.copy(source_file_path, dest_file_path)
+
+    def _posix_copy_dedup(self, source_path, destination_path):
+        """Copy source_path tree into destination_path, following symlinks.
+           Files with identical content are copied once, their duplicates are
+           hardlinked to this copy."""
+        duplicates = self._find_duplicate_files(source_path)
+        materialized = {}
+        linked = 0
+        # shutil.copytree() is not used here: its default copy_function
+        # shutil.copy2() does not manage directories. When the file is a
+        # symlink, copytree() resolves the link and directly calls copy2() with
+        # the target of the link, which fails with errno 21 when the target is
+        # a directory. Walking the tree with followlinks=True properly handles
+        # symlinks on directories.
+        for (current_dir, subdirs, filenames) in os.walk(source_path, followlinks=True):
+            dest_dir = os.path.normpath(os.path.join(destination_path,
+                                        os.path.relpath(current_dir, source_path)))
+            os.makedirs(dest_dir, exist_ok=True)
+            for filename in filenames:
+                source_file_path = os.path.join(current_dir, filename)
+                dest_file_path = os.path.join(dest_dir, filename)
+                group = duplicates.get(os.path.relpath(source_file_path, source_path))
+                if group in materialized:
+                    os.link(materialized[group], dest_file_path)
+                    linked += 1
+                    continue
+                shutil.copy2(source_file_path, dest_file_path)
+                if group is not None:
+                    materialized[group] = dest_file_path
+        logger.debug("posix push: %d duplicate files hardlinked", linked)
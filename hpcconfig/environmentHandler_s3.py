@@ -43,6 +43,7 @@ from hpcconfig import environmentHandler as eh
 
 class environmentHandler_s3(eh.environmentHandlerInterface):
 
+    mode = 's3'
     def __init__(self,conf):
         eh.environmentHandlerInterface.__init__(self, conf)
 
@@ -54,7 +55,7 @@ class environmentHandler_s3(eh.environmentHandlerInterface):
         bucket = self._bucket_conn_s3(self.conf)
 
         logger.info("S3 list: get remote objects list")
-        objs = bucket.list(prefix=self.conf.destination_root)
+        objs = bucket.list(prefix=self.destination_root)
         envs = []
         for obj in objs:
             name_members = obj.name.split('/')
@@ -71,7 +72,7 @@ class environmentHandler_s3(eh.environmentHandlerInterface):
         bucket = self._bucket_conn_s3(self.conf)
 
         logger.info("S3 push: get remote objects list")
-        obj_md5s = self._s3_list_md5(bucket, self.conf.destination)
+        obj_md5s = self._s3_list_md5(bucket, self.destination)
 
         touched_objects = []
 
@@ -79,17 +80,19 @@ class environmentHandler_s3(eh.environmentHandlerInterface):
 
 
         logger.info("S3 push: copying private files")
-        dir_files = os.path.join(self.conf.destination, 'files')
-        lst = self._s3_upload(self.conf.dir_files_private, bucket, dir_files, object_md5s=obj_md5s)
+        dir_files = os.path.join(self.destination, 'files')
+        duplicates = self._find_duplicate_files(self.conf.dir_files_private)
+        lst = self._s3_upload(self.conf.dir_files_private, bucket, dir_files,
+                              object_md5s=obj_md5s, duplicates=duplicates)
         touched_objects = list(set(touched_objects + lst))
         logger.info("S3 push: copying puppet conf")
-        lst = self._s3_upload(self.conf.conf_puppet, bucket, self.conf.destination, object_md5s=obj_md5s)
+        lst = self._s3_upload(self.conf.conf_puppet, bucket, self.destination, object_md5s=obj_md5s)
         touched_objects = list(set(touched_objects + lst))
         logger.info("S3 push: copying hiera conf")
-        lst = self._s3_upload(self.conf.conf_hiera, bucket, self.conf.destination, object_md5s=obj_md5s)
+        lst = self._s3_upload(self.conf.conf_hiera, bucket, self.destination, object_md5s=obj_md5s)
         touched_objects = list(set(touched_objects + lst))
         logger.info("S3 push: copying private cluster nodes description")
-        lst = self._s3_upload(self.conf.nodes_private, bucket, self.conf.destination, object_md5s=obj_md5s)
+        lst = self._s3_upload(self.conf.nodes_private, bucket, self.destination, object_md5s=obj_md5s)
         touched_objects = list(set(touched_objects + lst))
 
         logger.info("S3 push: Removing old files")
@@ -98,13 +101,61 @@ class environmentHandler_s3(eh.environmentHandlerInterface):
     def download(self):
         raise NotImplementedError("TODO")
 
+    def promote(self, source, destination):
+        """Promote environment with server-side copies of all its objects,
+           in parallel batches. Objects already identical in destination are
+           skipped and objects absent from source are removed."""
+        source = self.conf.environment_path(self.mode, *source)
+        destination = self.conf.environment_path(self.mode, *destination)
+        logger.info("S3 promote: copying %s to %s in bucket %s",
+                    source, destination, self.conf.s3_bucket_name)
+
+        bucket = self._bucket_conn_s3(self.conf)
+
+        src_md5s = self._s3_list_md5(bucket, source + '/')
+        if not src_md5s:
+            raise RuntimeError("source environment %s not found" % source)
+        dest_md5s = self._s3_list_md5(bucket, destination + '/')
+
+        # Create parent directories of destination if necessary
+        dest_dir_name = os.path.dirname(destination) + "/"
+        while dest_dir_name != "/" and bucket.get_key(dest_dir_name) is None:
+            logger.debug("S3 promote: Creating directory %s", dest_dir_name)
+            dest_dir = bucket.new_key(dest_dir_name)
+            dest_dir.set_contents_from_string('', policy='public-read')
+            dest_dir_name = os.path.dirname(dest_dir_name[:-1]) + "/"
+
+        pool = ThreadPool()
+        results = {}
+        touched_objects = []
+        batch = []
+        for src_name, src_md5 in src_md5s.items():
+            dest_name = destination + src_name[len(source):]
+            touched_objects.append(dest_name)
+            if dest_md5s.get(dest_name) == src_md5:
+                continue
+            batch.append((src_name, dest_name))
+            if len(batch) == 100:
+                results[len(results)] = pool.apply_async(
+                    self._s3_copy_keys, [bucket, batch])
+                batch = []
+        if batch:
+            results[len(results)] = pool.apply_async(
+                self._s3_copy_keys, [bucket, batch])
+        if results:
+            self._s3_wait_results(results, "S3 promote: Copied batches")
+        pool.close()
+        pool.join()
+
+        logger.info("S3 promote: Removing old files")
+        self._s3_remove_old_objects(bucket, dest_md5s, touched_objects)
+
     @eh.environmentHandlerInterface.arealoop
     def handle_area(self, area, **kwargs):
         logger.info("S3 push: copying area %s tarball", area)
-        area_dest = os.path.join(self.conf.destination, area)
+        area_dest = os.path.join(self.destination, area)
         lst = self._s3_upload(self.conf.archive_path(area), kwargs.get('bucket'), area_dest, object_md5s=kwargs.get('obj_md5s'))
-        touched_objects = kwargs.get('touched_objects')
-        touched_objects = list(set(touched_objects + lst))
+        kwargs['touched_objects'].extend(lst)
 
     def _s3_upload_file(self, source_file_path,
                         bucket,
@@ -115,28 +166,9 @@ class environmentHandler_s3(eh.environmentHandlerInterface):
         #size of parts when uploading in parts
         part_size = 6 * 1000 * 1000
 
-        if object_md5s is None:
-            oject_md5s = {}
-
-        # Check if the file has changed
-        if destination_file_path in object_md5s.keys():
-            remote_md5 = object_md5s[destination_file_path]
-        else:
-            remote_key = bucket.get_key(destination_file_path)
-            if remote_key is not None:
-                remote_md5 = remote_key.etag[1:-1]
-            else:
-                remote_md5 = None
-        local_md5 = hashlib.md5(open(source_file_path, 'rb').read()).hexdigest()
-        if remote_md5 == local_md5:
-            logger.debug("S3 upload: MD5 Match for file %s", source_file_path)
+        if self._s3_file_unchanged(source_file_path, bucket,
+                                   destination_file_path, object_md5s):
             return
-        else:
-            logger.debug("S3 upload: MD5 Mismatch for file %s (%s != %s)",
-                         source_file_path,
-                         remote_md5,
-                         local_md5)
-
 
         # Determine upload method
         filesize = os.path.getsize(source_file_path)
@@ -162,17 +194,88 @@ class environmentHandler_s3(eh.environmentHandlerInterface):
                          bytes_written, filesize, source_file_path)
 
 
+    def _s3_file_unchanged(self, source_file_path,
+                           bucket,
+                           destination_file_path,
+                           object_md5s=None):
+        """Returns True if the remote object has the same MD5 than the local
+           file."""
+        if object_md5s is None:
+            object_md5s = {}
+
+        # Check if the file has changed
+        if destination_file_path in object_md5s.keys():
+            remote_md5 = object_md5s[destination_file_path]
+        else:
+            remote_key = bucket.get_key(destination_file_path)
+            if remote_key is not None:
+                remote_md5 = remote_key.etag[1:-1]
+            else:
+                remote_md5 = None
+        local_md5 = hashlib.md5(open(source_file_path, 'rb').read()).hexdigest()
+        if remote_md5 == local_md5:
+            logger.debug("S3 upload: MD5 Match for file %s", source_file_path)
+            return True
+        else:
+            logger.debug("S3 upload: MD5 Mismatch for file %s (%s != %s)",
+                         source_file_path,
+                         remote_md5,
+                         local_md5)
+            return False
+
+    def _s3_copy_file(self, source_file_path,
+                      bucket,
+                      source_key_path,
+                      destination_file_path,
+                      object_md5s=None):
+        """Materialize destination_file_path with a server-side copy of the
+           already uploaded source_key_path object which has the same content
+           than source_file_path."""
+        if self._s3_file_unchanged(source_file_path, bucket,
+                                   destination_file_path, object_md5s):
+            return
+        logger.debug("S3 upload: server-side copy of %s to %s",
+                     source_key_path, destination_file_path)
+        bucket.copy_key(destination_file_path, bucket.name, source_key_path,
+                        headers={'x-amz-acl': 'public-read'})
+
+    def _s3_copy_keys(self, bucket, keys):
+        """Server-side copy of a list of tuples (source key, destination key)."""
+        for src_name, dest_name in keys:
+            logger.debug("S3 promote: copying %s to %s", src_name, dest_name)
+            bucket.copy_key(dest_name, bucket.name, src_name,
+                            headers={'x-amz-acl': 'public-read'})
+
+    def _s3_wait_results(self, results, message):
+        finished = 0
+        while finished < len(results):
+            finished = 0
+            for result in results.values():
+                if result.ready():
+                    finished += 1
+            logger.info("%s %d/%d", message, finished, len(results))
+            time.sleep(1)
+        for dest_file_path, result in results.items():
+            result.get()
+
     def _s3_upload(self, source_path,
                    bucket,
                    destination_path,
                    clean=True,
-                   object_md5s=None):
+                   object_md5s=None,
+                   duplicates=None):
+        """Upload source_path files to destination_path. Files listed in
+           duplicates (see _find_duplicate_files()) are uploaded once, the
+           other copies are then created with server-side copies."""
         upload_file_paths = self._list_upload_file_paths(source_path)
 
         if object_md5s is None:
             object_md5s = {}
+        if duplicates is None:
+            duplicates = {}
         pool = ThreadPool()
         results = {}
+        copies = []
 
         dirs = []
         touched_objects = []
@@ -196,23 +299,31 @@ class environmentHandler_s3(eh.environmentHandlerInterface):
                 # Continue with parent
                 dest_dir_name = os.path.dirname(dest_dir_name[:-1]) + "/"
 
+            touched_objects.append(dest_file_path)
+            original_path = duplicates.get(file_path, file_path)
+            if original_path != file_path:
+                copies.append((source_file_path,
+                               os.path.join(destination_path, original_path),
+                               dest_file_path))
+                continue
             results[dest_file_path] = pool.apply_async(
                 self._s3_upload_file,
                 [source_file_path, bucket, dest_file_path, object_md5s]
             )
-            touched_objects.append(dest_file_path)
 
+        self._s3_wait_results(results, "S3 push: Transfered files")
+
+        # Duplicates are copied once all original objects are uploaded
+        results = {}
+        for source_file_path, source_key_path, dest_file_path in copies:
+            results[dest_file_path] = pool.apply_async(
+                self._s3_copy_file,
+                [source_file_path, bucket, source_key_path, dest_file_path,
+                 object_md5s]
+            )
+        if results:
+            self._s3_wait_results(results, "S3 push: Copied files")
         pool.close()
-        finished = 0
-        while finished < len(results):
-            finished = 0
-            for result in results.values():
-                if result.ready():
-                    finished += 1
-            logger.info("S3 push: Transfered files %d/%d", finished, len(results))
-            time.sleep(1)
-        for dest_file_path, result in results.items():
-            result.get()
         pool.join()
         return touched_objects
 
@@ -28,6 +28,8 @@ import os
 import time
 import stat
 import socket
+import shlex
+import uuid
 import paramiko
 from datetime import datetime
 from multiprocessing.dummy import Pool as ThreadPool
@@ -38,8 +40,14 @@ import sys
 
 from hpcconfig import environmentHandler as eh
 
+# Timeouts in seconds of remote commands run over SSH, when they do not
+# produce any output or do not exit.
+SFTP_LINK_TIMEOUT = 120
+SFTP_PROMOTE_TIMEOUT = 1800
+
 class environmentHandler_sftp(eh.environmentHandlerInterface):
 
+    mode = 'sftp'
 
     def __init__(self,conf):
         eh.environmentHandlerInterface.__init__(self, conf)
@@ -50,7 +58,7 @@ class environmentHandler_sftp(eh.environmentHandlerInterface):
 
         logger.info("SFTP list: list environments on hosts %s", self.conf.sftp_hosts)
 
-        pool = Pool()
+        pool = self._sftp_pool()
         results = {}
         for host in self.conf.sftp_hosts:
            results[host] = pool.apply_async(self._sftp_list_host, [host, self.conf])
@@ -80,10 +88,18 @@ class environmentHandler_sftp(eh.environmentHandlerInterface):
     def upload(self):
         logger.info("SFTP push: pushing data on hosts %s", self.conf.sftp_hosts)
 
-        pool = Pool()
+        # identical private files are detected once for all hosts, they are
+        # linked remotely only if remote commands are allowed.
+        if self.conf.sftp_remote_commands:
+            duplicates = self._find_duplicate_files(self.conf.dir_files_private)
+        else:
+            duplicates = {}
+
+        pool = self._sftp_pool()
         results = {}
         for host in self.conf.sftp_hosts:
-           results[host] = pool.apply_async(self._sftp_push_host, [host, self.conf])
+           results[host] = pool.apply_async(self._sftp_push_host,
+                                            [host, self.conf, duplicates])
         pool.close()
         finished = 0
         while finished < len(results):
@@ -100,14 +116,49 @@ class environmentHandler_sftp(eh.environmentHandlerInterface):
     def download(self):
         raise NotImplementedError("TODO")
 
+    def promote(self, source, destination):
+        """Promote environment asynchronously on all SFTP servers."""
+        if not self.conf.sftp_remote_commands:
+            raise RuntimeError("SFTP promotion requires remote_commands "
+                               "enabled in sftp section")
+        source = self.conf.environment_path(self.mode, *source)
+        destination = self.conf.environment_path(self.mode, *destination)
+        logger.info("SFTP promote: copying %s to %s on hosts %s",
+                    source, destination, self.conf.sftp_hosts)
+
+        pool = self._sftp_pool()
+        results = {}
+        for host in self.conf.sftp_hosts:
+           results[host] = pool.apply_async(self._sftp_promote_host,
+                                            [host, self.conf, source, destination])
+        pool.close()
+        finished = 0
+        while finished < len(results):
+            finished = 0
+            for result in results.values():
+                if result.ready():
+                    finished += 1
+            logger.info("SFTP promote: Finished host %d/%d", finished, len(results))
+            time.sleep(1)
+        for host, result in results.items():
+            result.get()
+        pool.join()
+
     @eh.environmentHandlerInterface.arealoop
     def handle_area(self, area, **kwargs):
         logger.debug("SFTP push: copying area %s tarball", area)
-        area_dest = os.path.join(self.conf.destination, area)
+        area_dest = os.path.join(self.destination, area)
         self._sftp_upload(self.conf.archive_path(area), kwargs.get('sftp_client'), area_dest)
 
     def test(self):
-        print(self.conf.mode)
+        print(self.conf.modes)
+
+    def _sftp_exists(self, sftp_client, path):
+        try:
+            sftp_client.stat(path)
+        except FileNotFoundError:
+            return False
+        return True
 
     def _sftp_is_dir(self, sftp_client, path):
         if sftp_client not in self._sftp_host_directories.keys():
@@ -168,19 +219,109 @@ class environmentHandler_sftp(eh.environmentHandlerInterface):
         sftp_client.mkdir(path)
         sftp_client.chmod(path, mode)
 
-    def _sftp_upload(self, source_path, sftp_client, destination_path, clean=True):
+    def _sftp_pool(self):
+        """Returns a pool of workers to run operations on all hosts. A single
+           handler is run in the main thread of hpc-config-push, which can
+           fork worker processes. When multiple push modes are configured,
+           handlers run in threads where forking is unsafe, threads are used
+           instead."""
+        if len(self.conf.modes) > 1:
+            return ThreadPool()
+        return Pool()
+
+    def _sftp_put(self, sftp_client, source_file_path, dest_file_path):
+        # Upload
+        sftp_client.put(source_file_path, dest_file_path, confirm=False)
+        # Set Perms
+        sftp_client.chmod(dest_file_path, 0o644)
+
+    def _sftp_upload(self, source_path, sftp_client, destination_path, clean=True,
+                     duplicates=None):
+        """Upload source_path files to destination_path. Files listed in
+           duplicates (see _find_duplicate_files()) are uploaded once, the
+           other copies are then hardlinked on the remote host."""
         upload_file_paths = self._list_upload_file_paths(source_path)
 
+        if duplicates is None:
+            duplicates = {}
+        links = []
+
         for file_path in upload_file_paths:
             source_file_path, dest_file_path = self._get_full_paths(
                 source_path, destination_path, file_path)
             # Create remote directory if necessary
             dest_dir_name = os.path.dirname(dest_file_path)
             self._sftp_mkdir(sftp_client, dest_dir_name)
-            # Upload
-            sftp_client.put(source_file_path, dest_file_path, confirm=False)
-            # Set Perms
-            sftp_client.chmod(dest_file_path, 0o644)
+            original_path = duplicates.get(file_path, file_path)
+            if original_path != file_path:
+                links.append((source_file_path,
+                              os.path.join(destination_path, original_path),
+                              dest_file_path))
+                continue
+            self._sftp_put(sftp_client, source_file_path, dest_file_path)
+
+        # Duplicates which could not be linked remotely are uploaded
+        for source_file_path, dest_file_path in self._sftp_link(sftp_client, links):
+            try:
+                sftp_client.remove(dest_file_path)
+            except FileNotFoundError:
+                pass
+            self._sftp_put(sftp_client, source_file_path, dest_file_path)
+
+    def _sftp_link(self, sftp_client, links, batch_size=100):
+        """Create remote hardlinks with ln commands executed in batches over the
+           SSH transport of the SFTP session. links is a list of tuples (local
+           source file, remote original file, remote link). Returns the list of
+           tuples (local source file, remote link) that could not be linked.
+           The last link of every batch is checked as a restricted account
+           (eg. ForceCommand internal-sftp) may exit successfully without
+           running the command."""
+        failed = []
+        for index in range(0, len(links), batch_size):
+            batch = links[index:index + batch_size]
+            cmd = ' && '.join(['ln -f %s %s' % (shlex.quote(original),
+                                                shlex.quote(link))
+                               for _, original, link in batch])
+            status, error = self._sftp_exec(sftp_client, cmd, SFTP_LINK_TIMEOUT)
+            if status == 0:
+                try:
+                    sftp_client.stat(batch[-1][2])
+                except FileNotFoundError:
+                    status = None
+                    error = "link %s not created" % batch[-1][2]
+            if status != 0:
+                logger.warning("SFTP push: remote link error: %s", error)
+                logger.debug("SFTP push: failed to link %d files remotely, "
+                             "uploading them", len(batch))
+                failed += [(source, link) for source, _, link in batch]
+        logger.debug("SFTP push: %d duplicate files linked remotely",
+                     len(links) - len(failed))
+        return failed
+
+    def _sftp_exec(self, sftp_client, cmd, timeout):
+        """Run a shell command on the remote host over the SSH transport of
+           the SFTP session. Returns a tuple with the exit status, or None if
+           the command could not be run or timed out, and the error output."""
+        channel = None
+        try:
+            channel = sftp_client.get_channel().get_transport().open_session()
+            channel.exec_command(cmd)
+            # Close stdin, so that a forced sftp-server started instead of the
+            # command does not wait for requests forever.
+            channel.shutdown_write()
+            channel.settimeout(timeout)
+            error = channel.makefile_stderr('rb').read().decode(errors='replace')
+            if not channel.status_event.wait(timeout):
+                raise socket.timeout()
+            status = channel.recv_exit_status()
+        except socket.timeout:
+            return None, "timeout after %ds" % timeout
+        except paramiko.ssh_exception.SSHException as e:
+            return None, str(e)
+        finally:
+            if channel is not None:
+                channel.close()
+        return status, error.strip()
 
     def _sftp_connect(self, host, conf, verb):
         """Connect to SFTP server host. Verb is used in prefix of log messages."""
@@ -200,24 +341,74 @@ class environmentHandler_sftp(eh.environmentHandlerInterface):
             return
         return paramiko.SFTPClient.from_transport(transport)
 
-    def _sftp_push_host(self, host, conf):
+    def _sftp_push_host(self, host, conf, duplicates=None):
 
         sftp_client = self._sftp_connect(host, conf, verb='push')
 
-        logger.debug("SFTP push: Cleaning destination %s", conf.destination)
-        self._sftp_rmrf(sftp_client, conf.destination)
+        logger.debug("SFTP push: Cleaning destination %s", self.destination)
+        self._sftp_rmrf(sftp_client, self.destination)
 
         self.handle_area(self.conf.areas, sftp_client=sftp_client)
 
         logger.debug("SFTP push: copying private files")
-        dir_files = os.path.join(conf.destination, 'files')
-        self._sftp_upload(conf.dir_files_private, sftp_client, dir_files)
+        dir_files = os.path.join(self.destination, 'files')
+        self._sftp_upload(conf.dir_files_private, sftp_client, dir_files,
+                          duplicates=duplicates)
         logger.debug("SFTP push: copying puppet conf")
-        self._sftp_upload(conf.conf_puppet, sftp_client, conf.destination)
+        self._sftp_upload(conf.conf_puppet, sftp_client, self.destination)
         logger.debug("SFTP push: copying hiera conf")
-        self._sftp_upload(conf.conf_hiera, sftp_client, conf.destination)
+        self._sftp_upload(conf.conf_hiera, sftp_client, self.destination)
         logger.debug("SFTP push: copying private cluster nodes description")
-        self._sftp_upload(conf.nodes_private, sftp_client, conf.destination)
+        self._sftp_upload(conf.nodes_private, sftp_client, self.destination)
+
+    def _sftp_promote_host(self, host, conf, source, destination):
+        """Promote environment on a specific SFTP server with a remote copy
+           made of hardlinks. The copy is built aside and then swapped with the
+           destination."""
+        sftp_client = self._sftp_connect(host, conf, verb='promote')
+        if sftp_client is None:
+            raise RuntimeError("unable to connect to host %s" % host)
+
+        if not self._sftp_is_dir(sftp_client, source):
+            raise RuntimeError("source environment %s not found on host %s"
+                               % (source, host))
+
+        logger.debug("SFTP promote: linking %s to %s on host %s",
+                     source, destination, host)
+        quoted = { 'source': shlex.quote(source),
+                   'destination': shlex.quote(destination),
+                   'parent': shlex.quote(os.path.dirname(destination) or '.'),
+                   'tmp': shlex.quote(destination + '.promote'),
+                   'old': shlex.quote(destination + '.old') }
+        cmd = ("rm -rf {tmp} {old} && mkdir -p {parent} && "
+               "cp -al {source} {tmp} && "
+               "{{ [ ! -e {destination} ] || mv {destination} {old}; }} && "
+               "mv {tmp} {destination} && rm -rf {old}").format(**quoted)
+        # A marker file unique to this promotion is created in source. It is
+        # found in destination only if the remote copy has actually been
+        # performed, as restricted accounts (eg. ForceCommand internal-sftp)
+        # may exit successfully without running the command.
+        marker = '.promote-%s' % uuid.uuid4().hex
+        sftp_client.open(os.path.join(source, marker), 'w').close()
+        try:
+            status, error = self._sftp_exec(sftp_client, cmd,
+                                            SFTP_PROMOTE_TIMEOUT)
+            if status != 0:
+                raise RuntimeError("remote copy failed on host %s: %s"
+                                   % (host, error))
+            for path in [destination + '.promote', destination + '.old']:
+                if self._sftp_exists(sftp_client, path):
+                    raise RuntimeError("remote copy left %s on host %s"
+                                       % (path, host))
+            if not self._sftp_exists(sftp_client,
+                                     os.path.join(destination, marker)):
+                raise RuntimeError("remote copy not performed on host %s, are "
+                                   "shell commands allowed?" % host)
+        finally:
+            for path in [os.path.join(source, marker),
+                         os.path.join(destination, marker)]:
+                if self._sftp_exists(sftp_client, path):
+                    sftp_client.remove(path)
 
     def _sftp_list_host(self, host, conf):
         """Returns a list of tuples with filename and mtime of pushed environments
@@ -225,7 +416,7 @@ class environmentHandler_sftp(eh.environmentHandlerInterface):
         sftp_client = self._sftp_connect(host, conf, verb='list')
 
         results = []
-        for attr in sftp_client.listdir_iter(conf.destination_root):
+        for attr in sftp_client.listdir_iter(self.destination_root):
             results.append((attr.filename,
                             datetime.utcfromtimestamp(attr.st_mtime) \
                               .strftime('%Y-%m-%d %H:%M:%S')))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 EDF SA
+# Contact:
+#       CCN - HPC <dsp-cspit-ccn-hpc@edf.fr>
+#       1, Avenue du General de Gaulle
+#       92140 Clamart
+#
+# Authors: CCN - HPC <dsp-cspit-ccn-hpc@edf.fr>
+#
+# This file is part of hpc-config.
+#
+# hpc-config is free software: you can redistribute in and/or
+# modify it under the terms of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with hpc-config. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Check the compiled index of cluster-node-classifier gives the same roles
+   and areas as the first matching descriptor, and that it is cached."""
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from importlib.machinery import SourceFileLoader
+
+import yaml
+from ClusterShell.NodeSet import NodeSet
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.dirname(TESTS_DIR)
+
+classifier = SourceFileLoader(
+    'cluster_node_classifier',
+    os.path.join(TOP_DIR, 'hpcconfig', 'cluster-node-classifier')).load_module()
+
+CONF = """
+cluster_name: test
+cluster_prefix: tc
+roles:
+  cn: [ 'node[1-10]', 'node[5-20]' ]
+  gpu: [ 'node[8-30]', 'gpu1' ]
+  front: [ 'login[1-2]', 'front' ]
+  other: [ 'login[3-4]' ]
+areas:
+  infra: [ 'node[15-18]', 'admin', 'login1' ]
+  user: [ 'front', 'node[1-25]' ]
+  batch: [ 'gpu', 'login[1-4]' ]
+"""
+
+
+def first_match_role(prefix, nodename, roles):
+    """Role of node given by the first matching descriptor."""
+    match = re.search(r"%s([a-z0-9]*[a-z]+)\d+" % prefix, nodename)
+    if match is not None:
+        return match.group(1)
+    node = nodename.split('.')[0]
+    for role, descriptors in roles.items():
+        for descriptor in descriptors:
+            if node in NodeSet(descriptor) or role == descriptor:
+                return role
+    return None
+
+
+def first_match_area(areas, role, nodename):
+    """Area of node given by the first matching descriptor."""
+    node = nodename.split('.')[0]
+    for area, descriptors in areas.items():
+        for descriptor in descriptors:
+            if node in NodeSet(descriptor) or role == descriptor:
+                return area
+    return 'default'
+
+
+class TestClassify(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = yaml.safe_load(CONF)
+        self.index = classifier.compile_index(self.conf, 'digest', 'test')
+        self.nodes = NodeSet('node[0-35],gpu[1-2],login[0-5],tcadmin1,tccn2,'
+                             'admin,front')
+
+    def assertFirstMatch(self):
+        for node in self.nodes:
+            role = first_match_role(self.conf['cluster_prefix'], node,
+                                    self.conf['roles'])
+            if role is None:
+                with self.assertRaises(classifier.ClassificationError):
+                    classifier.classify(node, self.index)
+                continue
+            area = first_match_area(self.conf['areas'], role, node)
+            self.assertEqual(classifier.classify(node, self.index),
+                             (role, area), node)
+            # domain names are ignored
+            self.assertEqual(classifier.classify(node + '.cluster', self.index),
+                             (role, area), node)
+
+    def test_ordered_descriptors(self):
+        self.assertFirstMatch()
+
+    def test_role_name_default(self):
+        # descriptor equal to role name matches all remaining nodes
+        self.conf['roles']['front'] = [ 'login[1-2]', 'front', 'gpu[1-2]' ]
+        self.index = classifier.compile_index(self.conf, 'digest', 'test')
+        self.assertFirstMatch()
+        self.assertEqual(classifier.classify('node35', self.index)[0], 'front')
+
+    def test_no_areas(self):
+        del self.conf['areas']
+        self.index = classifier.compile_index(self.conf, 'digest', 'test')
+        self.assertEqual(classifier.classify('node1', self.index), ('cn', 'default'))
+
+
+class TestIndexCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        conf_path = os.path.join(self.tmpdir, 'cluster-nodes.yaml')
+        with open(conf_path, 'w') as fh_c:
+            fh_c.write(CONF)
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        # the default index path is not writable
+        for patch in [mock.patch.object(classifier, 'CONF', conf_path),
+                      mock.patch.object(classifier, 'INDEX',
+                                        os.path.join(self.tmpdir, 'missing',
+                                                     'cluster-nodes.idx')),
+                      mock.patch.dict(os.environ,
+                                      {'HPC_CONFIG_CACHE_DIR': self.cache_dir})]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_cache_dir_fallback(self):
+        index = classifier.load_index(classifier.CONF)
+        self.assertTrue(os.path.isfile(os.path.join(self.cache_dir,
+                                                    'cluster-nodes.idx')))
+        with mock.patch.object(classifier, 'compile_index') as compile_index:
+            self.assertEqual(classifier.load_index(classifier.CONF), index)
+            compile_index.assert_not_called()
+
+    def test_other_conf_not_cached(self):
+        conf_path = os.path.join(self.tmpdir, 'other.yaml')
+        shutil.copy(classifier.CONF, conf_path)
+        classifier.load_index(conf_path)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
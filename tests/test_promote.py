@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 EDF SA
+# Contact:
+#       CCN - HPC <dsp-cspit-ccn-hpc@edf.fr>
+#       1, Avenue du General de Gaulle
+#       92140 Clamart
+#
+# Authors: CCN - HPC <dsp-cspit-ccn-hpc@edf.fr>
+#
+# This file is part of hpc-config.
+#
+# hpc-config is free software: you can redistribute in and/or
+# modify it under the terms of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with hpc-config. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Push an environment with posix mode, promote it to another environment and
+   extract the promoted environment as hpc-config-apply does on nodes."""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from importlib.machinery import SourceFileLoader
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, TOP_DIR)
+
+
+def load_script(name):
+    path = os.path.join(TOP_DIR, 'hpcconfig', name)
+    return SourceFileLoader(name.replace('-', '_'), path).load_module()
+
+
+class TestPromote(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.tmpdir, 'destination')
+        conf_file = os.path.join(self.tmpdir, 'push.conf')
+        with open(conf_file, 'w') as conf_f:
+            conf_f.write("[global]\n"
+                         "cluster = testcluster\n"
+                         "environment = testing\n"
+                         "destination = %s\n"
+                         "mode = posix\n"
+                         "[paths]\n"
+                         "tmp = %s\n"
+                         % (self.destination,
+                            os.path.join(self.tmpdir, 'tmp')))
+
+        # hpc-config-push expects to run in the directory of the sources
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(TESTS_DIR)
+
+        self.push = load_script('hpc-config-push')
+        self.push.conf.conf_file = conf_file
+        self.push.parse_conf()
+        # The module is shared with the tests of the same process, its
+        # runtime configuration is reset for the other tests.
+        self.addCleanup(setattr, self.push, 'conf', self.push.AppConf())
+
+        # hpc-config-apply selects puppet paths after the distribution on load
+        with mock.patch('hpcconfig.system.os_distribution',
+                        return_value='debian'):
+            self.apply = load_script('hpc-config-apply')
+        self.apply.PUPPET_ENV_BASE_PATH = os.path.join(self.tmpdir, 'environments')
+        self.apply.PUPPET_ENV_BASE_OWNER = os.getuid()
+        self.apply.PUPPET_ENV_BASE_GROUP = os.getgid()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def push_environment(self):
+        self.push.init_tmpd()
+        # Private files re-encryption requires eyaml and the test cluster has
+        # no private file, the private files build directory is just created.
+        os.makedirs(os.path.join(self.push.conf.dir_files_private, 'default'))
+        self.push.gen_env_conf()
+        self.push.build_tarballs()
+        self.assertTrue(self.push.run_env_handlers(self.env_handlers(), 'upload'))
+        self.push.cleanup_run()
+
+    def env_handlers(self):
+        from hpcconfig import environmentHandler
+        return [ (mode, environmentHandler.environmentHandlerFactory(self.push.conf, mode))
+                 for mode in self.push.conf.modes ]
+
+    def test_promote_other_environment(self):
+        self.push_environment()
+        self.assertTrue(self.push.run_env_handlers(self.env_handlers(), 'promote',
+                                                   ('testing', 'latest'),
+                                                   ('production', 'latest')))
+
+        self.apply.get_puppet_environment(self.destination, 'production', 'default')
+
+        env_path = os.path.join(self.apply.PUPPET_ENV_BASE_PATH, 'production')
+        self.assertTrue(os.path.isfile(os.path.join(env_path, 'manifests', 'cluster.pp')))
+        self.assertTrue(os.path.isfile(os.path.join(env_path, 'environment.conf')))
+        # only the promoted environment is left in base path
+        self.assertEqual(os.listdir(self.apply.PUPPET_ENV_BASE_PATH), ['production'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 EDF SA
+# Contact:
+#       CCN - HPC <dsp-cspit-ccn-hpc@edf.fr>
+#       1, Avenue du General de Gaulle
+#       92140 Clamart
+#
+# Authors: CCN - HPC <dsp-cspit-ccn-hpc@edf.fr>
+#
+# This file is part of hpc-config.
+#
+# hpc-config is free software: you can redistribute in and/or
+# modify it under the terms of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with hpc-config. If not, see
+# <http://www.gnu.org/licenses/>.
+
+"""Check hpc-config-push builds byte-identical area archives from unchanged
+   sources in reproducible mode."""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from importlib.machinery import SourceFileLoader
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, TOP_DIR)
+
+
+class TestReproducibleTarball(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # The sources are copied as their mtimes are modified by the test
+        for source in ['puppet-hpc', 'hpc-privatedata']:
+            shutil.copytree(os.path.join(TESTS_DIR, source),
+                            os.path.join(self.tmpdir, source))
+        conf_file = os.path.join(self.tmpdir, 'push.conf')
+        with open(conf_file, 'w') as conf_f:
+            conf_f.write("[global]\n"
+                         "cluster = testcluster\n"
+                         "[paths]\n"
+                         "tmp = %s\n" % os.path.join(self.tmpdir, 'tmp'))
+
+        # hpc-config-push expects to run in the directory of the sources
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmpdir)
+
+        self.push = SourceFileLoader(
+            'hpc_config_push',
+            os.path.join(TOP_DIR, 'hpcconfig', 'hpc-config-push')).load_module()
+        self.push.conf.conf_file = conf_file
+        self.push.parse_conf()
+        self.addCleanup(setattr, self.push, 'conf', self.push.AppConf())
+
+    def build_tarball(self):
+        """Build the main area archive and returns its content."""
+        self.push.init_tmpd()
+        self.push.gen_env_conf()
+        self.push.build_tarball('default')
+        with open(self.push.conf.archive_path('default'), 'rb') as fh:
+            return fh.read()
+
+    def touch_sources(self, mtime):
+        for source in ['puppet-hpc', 'hpc-privatedata']:
+            for root, dirs, files in os.walk(source):
+                for name in dirs + files:
+                    os.utime(os.path.join(root, name), (mtime, mtime))
+
+    def test_byte_identical(self):
+        self.touch_sources(1000000000)
+        first = self.build_tarball()
+        self.touch_sources(2000000000)
+        self.assertEqual(self.build_tarball(), first)
+
+
+if __name__ == '__main__':
+    unittest.main()